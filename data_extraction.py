@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
 import json
 import platform
 import sys
@@ -10,7 +11,7 @@ import os
 import csv
 
 import mpyq
-import six
+import numpy as np
 from pysc2 import maps
 from pysc2 import run_configs
 from pysc2.env import sc2_env
@@ -20,12 +21,15 @@ from pysc2.lib import features
 from pysc2.lib import point
 from pysc2.lib import protocol
 from pysc2.lib import remote_controller
-from scipy import sparse
 
 from absl import app
 from absl import flags
 from s2clientprotocol import sc2api_pb2 as sc_pb
 
+from feature_encoder import encode_array, make_encoder, max_record_size
+from feature_writer import COMPRESSED_SUFFIX, BackgroundWriter, FeatureWriter
+from replay_reader import DATA_DTYPE
+
 FLAGS = flags.FLAGS
 
 flags.DEFINE_float("fps", 30, "Frames per second to run the game.")
@@ -48,6 +52,22 @@ flags.mark_flag_as_required("replay")
 
 FLAGS(sys.argv)
 
+# Screen Features
+SCREEN_FEATURES = ['height_map', 'visibility_map', 'creep', 'power', 'player_id', 'player_relative',
+                   'unit_type', 'selected', 'unit_hit_point', 'unit_hit_point_ratio', 'unit_energy',
+                   'unit_energy_ratio', 'unit_shield', 'unit_shield_ratio', 'unit_density',
+                   'unit_density_ratio', 'effects']
+# Minimap Features
+MINIMAP_FEATURES = ['height_map', 'visibility_map', 'creep', 'camera', 'player_id', 'player_relative',
+                    'selected']
+# Other features
+OTHER_FEATURES = ['player', 'game_loop', 'score_cumulative', 'available_actions', 'single_select',
+                  'multi_select', 'cargo', 'cargo_slots_available', 'build_queue', 'control_groups']
+
+# Buffer size for the CSV outputs (other features and actions)
+CSV_BUFFER_SIZE = 8 * 1024 * 1024
+
+
 def main(unused_argv):
     """Run SC2 to play a game or a replay."""
     stopwatch.sw.enabled = FLAGS.profile or FLAGS.trace
@@ -87,78 +107,118 @@ def main(unused_argv):
             start_replay.map_data = run_config.map_data(map_path)
         controller.start_replay(start_replay)
 
+        # Create replay data foldr
+        data_folder = './replay_data/' + FLAGS.replay.split('\\')[-1][:10] + \
+                      '_player_{}'.format(FLAGS.observed_player)
+        os.makedirs(data_folder, exist_ok=True)
+
+        # Open one output file per feature for the whole replay instead of reopening it every step
+        files = []
+
+        def open_writer(name):
+            f = io.TextIOWrapper(open(data_folder + "/" + name + '.txt', 'wb', buffering=CSV_BUFFER_SIZE),
+                                 newline='', write_through=False)
+            files.append(f)
+            return csv.writer(f)
+
+        def open_binary(name):
+            f = FeatureWriter(data_folder + "/" + name + '.bin' + COMPRESSED_SUFFIX)
+            files.append(f)
+            return f
+
+        # Encoders specialised for the fixed screen/minimap stacks, sharing one scratch buffer
+        screen_shape = (len(SCREEN_FEATURES), FLAGS.screen_resolution, FLAGS.screen_resolution)
+        minimap_shape = (len(MINIMAP_FEATURES), FLAGS.minimap_resolution, FLAGS.minimap_resolution)
+        encode_screen = make_encoder(screen_shape, DATA_DTYPE)
+        encode_minimap = make_encoder(minimap_shape, DATA_DTYPE)
+        screen_size = screen_shape[0] * max_record_size(screen_shape[1:])
+        scratch = np.empty(screen_size + minimap_shape[0] * max_record_size(minimap_shape[1:]), dtype=np.uint8)
+        screen_buf, minimap_buf = scratch[:screen_size], scratch[screen_size:]
+        screen_offsets = np.empty(screen_shape[0] + 1, dtype=np.int64)
+        minimap_offsets = np.empty(minimap_shape[0] + 1, dtype=np.int64)
+        # Where the encoded records of each stack end up every frame
+        encoded_layers = {'screen': (screen_buf, screen_offsets), 'minimap': (minimap_buf, minimap_offsets)}
+
+        # (kind, layer index or obs_t key, output) for every feature, used for the whole replay
+        layer_jobs = ([('screen', i, open_binary('screen_' + name)) for i, name in enumerate(SCREEN_FEATURES)] +
+                      [('minimap', i, open_binary('minimap_' + name)) for i, name in enumerate(MINIMAP_FEATURES)])
+        action_writer = open_writer('action')
+
+        # Completed on the first frame, once it is known which other features come back as ndarrays
+        jobs = None
+        background_writer = None
+
+        frame_period_ns = int(1e9 / FLAGS.fps)
+
         try:
             feat = features.Features(controller.game_info())
             while True:
-                frame_start_time = time.time()
+                frame_start_ns = time.monotonic_ns()
                 controller.step(FLAGS.step_mul)
                 obs = controller.observe()
                 obs_t = feat.transform_obs(obs.observation)
 
-                # Screen Features
-                screen_features = ['height_map', 'visibility_map', 'creep', 'power', 'player_id', 'player_relative',
-                                 'unit_type', 'selected', 'unit_hit_point', 'unit_hit_point_ratio', 'unit_energy',
-                                 'unit_energy_ratio', 'unit_shield', 'unit_shield_ratio', 'unit_density',
-                                 'unit_density_ratio', 'effects']
-                # Minimap Features
-                minimap_features = ['height_map', 'visibility_map', 'creep', 'camera', 'player_id', 'player_relative',
-                                  'selected']
-                # Other features
-                other_features = ['player', 'game_loop', 'score_cumulative', 'available_actions', 'single_select',
-                                'multi_select', 'cargo', 'cargo_slots_available', 'build_queue', 'control_groups']
-
-                # Create replay data foldr
-                data_folder = './replay_data/' + FLAGS.replay.split('\\')[-1][:10] + \
-                            '_player_{}'.format(FLAGS.observed_player)
-                if not os.path.exists(data_folder):
-                    os.makedirs(data_folder)
-
-                # Write screen features
-                for i in range(len(screen_features)):
-                    data_path = data_folder + "/" + 'screen_' + screen_features[i] + '.txt'
-                    mode = 'a+' if os.path.exists(data_path) else 'w+'
-                    with open(data_path, mode, newline='') as f:
-                        writer = csv.writer(f)
-                        writer.writerows(csr_matrix_to_list(sparse.csr_matrix(obs_t['screen'][i])))
-
-                # Write minimap features
-                for i in range(len(minimap_features)):
-                    data_path = data_folder + "/" + 'minimap_' + minimap_features[i] + '.txt'
-                    mode = 'a+' if os.path.exists(data_path) else 'w+'
-                    with open(data_path, mode, newline='') as f:
-                        writer = csv.writer(f)
-                        writer.writerows(csr_matrix_to_list(sparse.csr_matrix(obs_t['minimap'][i])))
-
-                # Write other features
-                for i in other_features:
-                    data_path = data_folder + "/" + i + '.txt'
-                    mode = 'a+' if os.path.exists(data_path) else 'w+'
-                    with open(data_path, mode, newline='') as f:
-                        writer = csv.writer(f)
-                        writer.writerows([obs_t[i]])
+                game_loop = int(obs_t['game_loop'][0])
+
+                # One contiguous (layers, rows, cols) int16 stack each, the encoders read every layer in place
+                screen = np.ascontiguousarray(obs_t['screen'], dtype=DATA_DTYPE)
+                minimap = np.ascontiguousarray(obs_t['minimap'], dtype=DATA_DTYPE)
+
+                if jobs is None:
+                    # Other features that are not ndarrays on the first frame keep going to a CSV file
+                    jobs = layer_jobs + [('other', name, open_binary(name)) if isinstance(obs_t[name], np.ndarray)
+                                         else ('csv', name, open_writer(name)) for name in OTHER_FEATURES]
+                    feature_writers = [f for kind, _, f in jobs if kind != 'csv']
+                    background_writer = BackgroundWriter(feature_writers)
+
+                encode_screen(screen, game_loop, screen_buf, screen_offsets)
+                encode_minimap(minimap, game_loop, minimap_buf, minimap_offsets)
+
+                # Write screen, minimap and other features in one pass
+                for kind, key, f in jobs:
+                    if kind == 'other':
+                        f.write(encode_array(obs_t[key], game_loop))
+                    elif kind == 'csv':
+                        f.writerows([obs_t[key]])
+                    else:
+                        buf, offsets = encoded_layers[kind]
+                        f.write(buf[offsets[key]:offsets[key + 1]])
+
+                # Hand features with FLUSH_THRESHOLD bytes pending to the compression thread
+                background_writer.flush(feature_writers)
 
                 # Write actions
+                game_loop_list = obs_t['game_loop'].tolist()
                 for action in obs.actions:
                     try:
-                        func = feat.reverse_action(action).function
-                        args = feat.reverse_action(action).arguments
+                        function_call = feat.reverse_action(action)
+                        func = function_call.function
+                        args = function_call.arguments
                         try:
                             print(func, args)
                         except OSError:
                             pass
 
-                        data_path = data_folder + "/" + 'action' + '.txt'
-                        mode = 'a+' if os.path.exists(data_path) else 'w+'
-                        with open(data_path, mode, newline='') as f:
-                            writer = csv.writer(f)
-                            writer.writerows([obs_t['game_loop'].tolist(), [func], [args]])
+                        action_writer.writerows([game_loop_list, [func], [args]])
                     except ValueError:
                         pass
                 if obs.player_result:
                     break
-                time.sleep(max(0, frame_start_time + 1 / FLAGS.fps - time.time()))
+                remaining_ns = frame_period_ns - (time.monotonic_ns() - frame_start_ns)
+                if remaining_ns > 0:
+                    time.sleep(remaining_ns * 1e-9)
         except KeyboardInterrupt:
             pass
+        finally:
+            # Still write out what is pending, but don't let a writer failure mask an exception already raised
+            failing = sys.exc_info()[0] is not None
+            try:
+                if background_writer is not None:
+                    background_writer.flush(feature_writers, threshold=0, check=False)
+                    background_writer.close(check=not failing)
+            finally:
+                for f in files:
+                    f.close()
         print("Score: ", obs.observation.score.score)
         print("Result: ", obs.player_result)
 
@@ -167,24 +227,13 @@ def main(unused_argv):
 
 
 def get_game_version(replay_data):
-    replay_io = six.BytesIO()
-    replay_io.write(replay_data)
-    replay_io.seek(0)
-    archive = mpyq.MPQArchive(replay_io).extract()
-    metadata = json.loads(archive[b"replay.gamemetadata.json"].decode("utf-8"))
+    # Only the metadata entry is needed, so skip the listfile and don't extract the rest of the archive
+    archive = mpyq.MPQArchive(io.BytesIO(replay_data), listfile=False)
+    metadata = json.loads(archive.read_file(b"replay.gamemetadata.json").decode("utf-8"))
     version = metadata["GameVersion"]
     return ".".join(version.split(".")[:-1])
 
 
-def csr_matrix_to_list(sparse_matrix):
-    result = [
-        sparse_matrix.data.tolist(),
-        sparse_matrix.indices.tolist(),
-        sparse_matrix.indptr.tolist()
-    ]
-    return result
-
-
 def entry_point():  # Needed so setup.py scripts work.
     app.run(main)
 
@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import struct
+
+import numpy as np
+
+from replay_reader import RECORD_HEADER, SPARSE_TAG, DENSE_TAG, DATA_DTYPE, INDEX_DTYPE, ARRAY_HEADER, ARRAY_DTYPE
+
+try:
+    from numba import from_dtype, njit, types
+except ImportError:
+    njit = None
+
+# Layers with more nonzero cells than this fraction are cheaper to store dense than as csr
+DENSE_THRESHOLD = 0.25
+
+
+def encode_array(arr, game_loop):
+    # One record per frame, see replay_reader.read_array_feature for the layout
+    arr = np.ascontiguousarray(arr, dtype=ARRAY_DTYPE)
+    return ARRAY_HEADER.pack(game_loop, arr.ndim) + struct.pack('<%dI' % arr.ndim, *arr.shape) + arr.tobytes()
+
+
+def dense_to_csr(arr):
+    # Same data/indices/indptr layout as scipy's csr_matrix, read straight off the dense array
+    rows, cols = np.nonzero(arr)
+    indptr = np.zeros(arr.shape[0] + 1, dtype=INDEX_DTYPE)
+    np.cumsum(np.bincount(rows, minlength=arr.shape[0]), out=indptr[1:])
+    return arr[rows, cols].astype(DATA_DTYPE), cols.astype(INDEX_DTYPE), indptr
+
+
+def max_record_size(shape):
+    # Sparse records are only written below DENSE_THRESHOLD, so this bounds both layouts
+    return RECORD_HEADER.size + 6 * shape[0] * shape[1] + INDEX_DTYPE.itemsize * (shape[0] + 1)
+
+
+def encode_feature(arr, game_loop, out_buf):
+    # Encode one frame into out_buf and return its length, see replay_reader.read_feature_layer for the layout
+    if np.count_nonzero(arr) > DENSE_THRESHOLD * arr.size:
+        record = RECORD_HEADER.pack(DENSE_TAG, arr.size, 0, game_loop) + arr.astype(DATA_DTYPE).tobytes()
+    else:
+        data, indices, indptr = dense_to_csr(arr)
+        record = (RECORD_HEADER.pack(SPARSE_TAG, len(data), len(indices), game_loop) +
+                  data.tobytes() + indices.tobytes() + indptr.tobytes())
+    out_buf[:len(record)] = np.frombuffer(record, dtype=np.uint8)
+    return len(record)
+
+
+_SPARSE_TAG_BYTE = ord(SPARSE_TAG)
+_DENSE_TAG_BYTE = ord(DENSE_TAG)
+
+
+def _put_i16(buf, pos, value):
+    buf[pos] = value & 0xff
+    buf[pos + 1] = (value >> 8) & 0xff
+    return pos + 2
+
+
+def _put_u32(buf, pos, value):
+    buf[pos] = value & 0xff
+    buf[pos + 1] = (value >> 8) & 0xff
+    buf[pos + 2] = (value >> 16) & 0xff
+    buf[pos + 3] = (value >> 24) & 0xff
+    return pos + 4
+
+
+def _encode_layer(arr, rows, cols, game_loop, out_buf, pos):
+    # Same bytes as encode_feature, written straight into out_buf at pos without temporary arrays
+    nnz = 0
+    for r in range(rows):
+        for c in range(cols):
+            if arr[r, c] != 0:
+                nnz += 1
+
+    if nnz > DENSE_THRESHOLD * rows * cols:
+        out_buf[pos] = _DENSE_TAG_BYTE
+        _put_u32(out_buf, pos + 1, rows * cols)
+        _put_u32(out_buf, pos + 5, 0)
+        pos = _put_u32(out_buf, pos + 9, game_loop)
+        for r in range(rows):
+            for c in range(cols):
+                pos = _put_i16(out_buf, pos, arr[r, c])
+        return pos
+
+    out_buf[pos] = _SPARSE_TAG_BYTE
+    _put_u32(out_buf, pos + 1, nnz)
+    _put_u32(out_buf, pos + 5, nnz)
+    data_pos = _put_u32(out_buf, pos + 9, game_loop)
+    index_pos = data_pos + 2 * nnz
+    indptr_pos = _put_u32(out_buf, index_pos + 4 * nnz, 0)
+    count = 0
+    for r in range(rows):
+        for c in range(cols):
+            if arr[r, c] != 0:
+                data_pos = _put_i16(out_buf, data_pos, arr[r, c])
+                index_pos = _put_u32(out_buf, index_pos, c)
+                count += 1
+        indptr_pos = _put_u32(out_buf, indptr_pos, count)
+    return indptr_pos
+
+
+if njit is not None:
+    _put_i16 = njit(cache=True)(_put_i16)
+    _put_u32 = njit(cache=True)(_put_u32)
+    _encode_layer = njit(cache=True, inline='always')(_encode_layer)
+
+
+def make_encoder(shape, dtype):
+    """Return encode(stack, game_loop, out_buf, offsets) for a C-contiguous (layers, rows, cols) stack.
+
+    The records of all layers are written back to back into out_buf, which needs
+    layers * max_record_size((rows, cols)) bytes, and layer i's record is out_buf[offsets[i]:offsets[i + 1]].
+    With numba the kernel is compiled here, with the layer count and resolution as constants.
+    Raises TypeError if the stack is not of this dtype, the way numba rejects a call outside the compiled
+    signature, and ValueError if it does not have this shape or out_buf/offsets are too small.
+    """
+    layers, rows, cols = shape
+    dtype = np.dtype(dtype)
+    buf_size = layers * max_record_size((rows, cols))
+
+    if njit is None:
+        def encode(stack, game_loop, out_buf, offsets):
+            if stack.dtype != dtype:
+                raise TypeError("stack dtype %s does not match the encoder's %s" % (stack.dtype, dtype))
+            if tuple(stack.shape) != (layers, rows, cols):
+                raise ValueError("stack shape %s does not match the encoder's %s" % (stack.shape, shape))
+            if out_buf.shape[0] < buf_size or offsets.shape[0] < layers + 1:
+                raise ValueError("out_buf or offsets is too small for the encoder's shape")
+            pos = offsets[0] = 0
+            for layer in range(layers):
+                pos += encode_feature(stack[layer], game_loop, out_buf[pos:])
+                offsets[layer + 1] = pos
+            return pos
+        return encode
+
+    signature = types.int64(from_dtype(dtype)[:, :, ::1], types.int64, types.uint8[::1], types.int64[::1])
+
+    @njit(signature)
+    def encode(stack, game_loop, out_buf, offsets):
+        # The kernel loops over the compiled-in shape and numba does no bounds checking, so check up front
+        if stack.shape[0] != layers or stack.shape[1] != rows or stack.shape[2] != cols:
+            raise ValueError("stack shape does not match the encoder's shape")
+        if out_buf.shape[0] < buf_size or offsets.shape[0] < layers + 1:
+            raise ValueError("out_buf or offsets is too small for the encoder's shape")
+        pos = offsets[0] = 0
+        for layer in range(layers):
+            pos = _encode_layer(stack[layer], rows, cols, game_loop, out_buf, pos)
+            offsets[layer + 1] = pos
+        return pos
+    return encode
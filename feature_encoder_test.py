@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import os
+import struct
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from unittest import mock
+import numpy as np
+
+import feature_encoder
+import replay_reader
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SHAPE = (17, 84, 84)
+
+# A 3 x 4 layer with 2 nonzero cells is stored as csr, one with 4 (more than a quarter) is stored dense
+SMALL_STACK = np.array([[[7, 0, 0, 0], [0, 0, -2, 0], [0, 0, 0, 0]],
+                        [[1, -1, 0, 0], [0, 0, 0, 0], [0, 0, 300, 5]]], dtype=replay_reader.DATA_DTYPE)
+# (tag, n_data, n_indices, game_loop), then int16 data, int32 column indices and int32 indptr
+SPARSE_RECORD = (struct.pack('<cIII', b'S', 2, 2, 77) + struct.pack('<2h', 7, -2) + struct.pack('<2i', 0, 2) +
+                 struct.pack('<4i', 0, 1, 2, 2))
+# (tag, n_data, 0, game_loop), then the whole layer as int16
+DENSE_RECORD = struct.pack('<cIII', b'D', 12, 0, 77) + struct.pack('<12h', 1, -1, 0, 0, 0, 0, 0, 0, 0, 0, 300, 5)
+
+
+def random_stack(shape, seed=0):
+    # Layer densities from empty to full, so both sides of DENSE_THRESHOLD are covered
+    rng = np.random.RandomState(seed)
+    density = np.linspace(0, 1, shape[0])[:, None, None]
+    values = rng.randint(-3, 3000, size=shape)
+    return np.ascontiguousarray((rng.random_sample(shape) < density) * values, dtype=replay_reader.DATA_DTYPE)
+
+
+def encode_stack(encode, stack, game_loop):
+    out_buf = np.empty(stack.shape[0] * feature_encoder.max_record_size(stack.shape[1:]), dtype=np.uint8)
+    offsets = np.empty(stack.shape[0] + 1, dtype=np.int64)
+    encode(stack, game_loop, out_buf, offsets)
+    return [out_buf[offsets[i]:offsets[i + 1]].tobytes() for i in range(stack.shape[0])]
+
+
+class FeatureEncoderTest(parameterized.TestCase):
+
+    def write(self, name, chunks):
+        # Like data_extraction.py, every chunk is compressed on its own into a zstd frame or gzip member
+        path = os.path.join(self.create_tempdir().full_path, name)
+        if name.endswith('.zst'):
+            chunks = [zstandard.ZstdCompressor().compress(chunk) for chunk in chunks]
+        elif name.endswith('.gz'):
+            chunks = [gzip.compress(chunk) for chunk in chunks]
+        with open(path, 'wb') as f:
+            f.write(b''.join(chunks))
+        return path
+
+    @parameterized.parameters(True, False)
+    def test_encoder_writes_documented_records(self, use_numba):
+        if use_numba and feature_encoder.njit is None:
+            self.skipTest('numba is not installed')
+        with mock.patch.object(feature_encoder, 'njit', feature_encoder.njit if use_numba else None):
+            encode = feature_encoder.make_encoder(SMALL_STACK.shape, replay_reader.DATA_DTYPE)
+        out_buf = np.empty(2 * feature_encoder.max_record_size(SMALL_STACK.shape[1:]), dtype=np.uint8)
+        offsets = np.empty(3, dtype=np.int64)
+        size = encode(SMALL_STACK, 77, out_buf, offsets)
+        self.assertEqual(size, len(SPARSE_RECORD) + len(DENSE_RECORD))
+        self.assertEqual(offsets.tolist(), [0, len(SPARSE_RECORD), size])
+        self.assertEqual(out_buf[:size].tobytes(), SPARSE_RECORD + DENSE_RECORD)
+
+    @parameterized.named_parameters(('sparse', 0, SPARSE_RECORD), ('dense', 1, DENSE_RECORD))
+    def test_encode_feature_writes_documented_record(self, layer, record):
+        out_buf = np.empty(feature_encoder.max_record_size(SMALL_STACK.shape[1:]), dtype=np.uint8)
+        size = feature_encoder.encode_feature(SMALL_STACK[layer], 77, out_buf)
+        self.assertEqual(out_buf[:size].tobytes(), record)
+
+    @parameterized.parameters('.bin', '.bin.gz', '.bin.zst')
+    def test_feature_layer_round_trip(self, suffix):
+        if suffix.endswith('.zst') and zstandard is None:
+            self.skipTest('zstandard is not installed')
+        encode = feature_encoder.make_encoder(SHAPE, replay_reader.DATA_DTYPE)
+        stacks = [random_stack(SHAPE, seed) for seed in range(3)]
+        layer_records = zip(*[encode_stack(encode, stack, 10 * i) for i, stack in enumerate(stacks)])
+        for layer, records in enumerate(layer_records):
+            path = self.write('screen_%d%s' % (layer, suffix), records)
+            frames = list(replay_reader.read_feature_layer(path, SHAPE[1:]))
+            self.assertEqual([game_loop for game_loop, _ in frames], [0, 10, 20])
+            for (_, arr), stack in zip(frames, stacks):
+                np.testing.assert_array_equal(arr, stack[layer])
+                self.assertTrue(arr.flags.writeable)
+
+    @parameterized.parameters('.bin', '.bin.gz', '.bin.zst')
+    def test_array_feature_round_trip(self, suffix):
+        if suffix.endswith('.zst') and zstandard is None:
+            self.skipTest('zstandard is not installed')
+        arrays = [np.arange(11), np.zeros((0, 7), dtype=np.int64), np.arange(-6, 6).reshape(3, 4)]
+        chunks = [feature_encoder.encode_array(arr, i) for i, arr in enumerate(arrays)]
+        frames = list(replay_reader.read_array_feature(self.write('player' + suffix, chunks)))
+        self.assertEqual([game_loop for game_loop, _ in frames], [0, 1, 2])
+        for (_, arr), expected in zip(frames, arrays):
+            np.testing.assert_array_equal(arr, expected)
+            self.assertEqual(arr.shape, expected.shape)
+            self.assertTrue(arr.flags.writeable)
+
+    @parameterized.parameters(True, False)
+    def test_encoder_rejects_mismatched_arrays(self, use_numba):
+        if use_numba and feature_encoder.njit is None:
+            self.skipTest('numba is not installed')
+        with mock.patch.object(feature_encoder, 'njit', feature_encoder.njit if use_numba else None):
+            encode = feature_encoder.make_encoder(SHAPE, replay_reader.DATA_DTYPE)
+        out_buf = np.empty(SHAPE[0] * feature_encoder.max_record_size(SHAPE[1:]), dtype=np.uint8)
+        offsets = np.empty(SHAPE[0] + 1, dtype=np.int64)
+        with self.assertRaises(ValueError):
+            encode(random_stack((13, 64, 64)), 0, out_buf, offsets)
+        with self.assertRaises(ValueError):
+            encode(random_stack(SHAPE), 0, out_buf[:100], offsets)
+        with self.assertRaises(ValueError):
+            encode(random_stack(SHAPE), 0, out_buf, offsets[:SHAPE[0]])
+        with self.assertRaises(TypeError):
+            encode(random_stack(SHAPE).astype(np.int32), 0, out_buf, offsets)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,166 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import os
+import queue
+import threading
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encoded frames are collected per feature and written out once this many bytes are pending
+FLUSH_THRESHOLD = 256 * 1024
+# At most this many flushed batches wait for the compression thread before the replay loop blocks
+BACKGROUND_QUEUE_SIZE = 4
+
+# Flushed chunks are compressed as independent zstd frames (or gzip members), which decode as one stream
+if zstandard is not None:
+    COMPRESSED_SUFFIX = '.zst'
+    compress = zstandard.ZstdCompressor(level=1).compress
+else:
+    COMPRESSED_SUFFIX = '.gz'
+
+    def compress(data):
+        return gzip.compress(data, compresslevel=1)
+
+
+class FeatureWriter(object):
+    """Collects encoded frames for one .bin file until a BackgroundWriter takes them over."""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=0)
+        self.fd = self.file.fileno()
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf.extend(data)
+
+    def close(self):
+        self.file.close()
+
+
+def write_fully(fd, data):
+    written = 0
+    with memoryview(data) as view:
+        while written < len(view):
+            written += os.write(fd, view[written:])
+
+
+class UringFlusher(object):
+    """Writes chunks to several registered files with a single io_uring submission."""
+
+    # Offset -1 makes the kernel write at, and advance, the current file position
+    CURRENT_POSITION = (1 << 64) - 1
+
+    def __init__(self, writers):
+        self.ring = liburing.Ring()
+        liburing.io_uring_queue_init(len(writers), self.ring)
+        try:
+            # Appending at the current position needs IORING_FEAT_RW_CUR_POS (Linux 5.6)
+            if not self.ring.features & liburing.IORING_FEAT_RW_CUR_POS:
+                raise OSError("io_uring does not support writing at the current file position")
+            self.files = liburing.FileIndex([w.fd for w in writers])
+            liburing.io_uring_register_files(self.ring, self.files)
+        except Exception:
+            liburing.io_uring_queue_exit(self.ring)
+            raise
+        self.slots = {w.fd: i for i, w in enumerate(writers)}
+        self.cqe = liburing.Cqe()
+
+    def write(self, chunks):
+        for i, (fd, data) in enumerate(chunks):
+            sqe = liburing.io_uring_get_sqe(self.ring)
+            liburing.io_uring_prep_write(sqe, self.slots[fd], data, self.CURRENT_POSITION)
+            liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+            liburing.io_uring_sqe_set_data64(sqe, i)
+        liburing.io_uring_submit_and_wait(self.ring, len(chunks))
+        written = [0] * len(chunks)
+        for _ in chunks:
+            liburing.io_uring_wait_cqe(self.ring, self.cqe)
+            entry = self.cqe[0]
+            i, res = entry.user_data, entry.res
+            liburing.io_uring_cq_advance(self.ring, 1)
+            written[i] = liburing.trap_error(res)
+        # Finish short writes, if any, the plain way
+        for (fd, data), n in zip(chunks, written):
+            if n < len(data):
+                write_fully(fd, memoryview(data)[n:])
+
+    def close(self):
+        liburing.io_uring_unregister_files(self.ring)
+        liburing.io_uring_queue_exit(self.ring)
+
+
+def open_uring_flusher(writers):
+    # Fall back to one write() per file when io_uring is not installed or not usable on this kernel.
+    # AttributeError covers the older python-liburing releases, which have a different API.
+    if liburing is None:
+        return None
+    try:
+        return UringFlusher(writers)
+    except (AttributeError, OSError):
+        return None
+
+
+class BackgroundWriter(object):
+    """Compresses and writes FeatureWriter buffers on a separate thread while the replay keeps stepping."""
+
+    def __init__(self, writers):
+        self.uring = open_uring_flusher(writers)
+        self.queue = queue.Queue(maxsize=BACKGROUND_QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def flush(self, writers, threshold=FLUSH_THRESHOLD, check=True):
+        # Hand the pending buffers over to the thread and start new ones
+        if check:
+            self.check()
+        batch = [(w, w.buf) for w in writers if w.buf and len(w.buf) >= threshold]
+        if not batch:
+            return
+        # put blocks while the queue is full and is where a Ctrl-C tends to land, so only start new
+        # buffers once the batch is queued, otherwise the final flush would not see these frames
+        self.queue.put([(w.fd, buf) for w, buf in batch])
+        for w, _ in batch:
+            w.buf = bytearray()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                chunks = [(fd, compress(buf)) for fd, buf in batch]
+                if self.uring is not None and len(chunks) > 1:
+                    self.uring.write(chunks)
+                else:
+                    for fd, data in chunks:
+                        write_fully(fd, data)
+            except Exception as e:
+                self.error = e
+
+    def check(self):
+        # Stop the replay as soon as a write has failed instead of dropping every later batch
+        if self.error is not None:
+            raise self.error
+
+    def close(self, check=True):
+        self.queue.put(None)
+        self.thread.join()
+        if self.uring is not None:
+            self.uring.close()
+        if check:
+            self.check()
@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from unittest import mock
+import numpy as np
+
+import feature_encoder
+import feature_writer
+import replay_reader
+
+SHAPE = (8, 8)
+
+
+def random_layers(frames, seed=0):
+    # Frames from empty to full, so both sparse and dense records are written
+    rng = np.random.RandomState(seed)
+    density = np.linspace(0, 1, frames)[:, None, None]
+    values = rng.randint(-3, 3000, size=(frames,) + SHAPE)
+    shape = (frames,) + SHAPE
+    return ((rng.random_sample(shape) < density) * values).astype(replay_reader.DATA_DTYPE)
+
+
+def wait_for_error(background_writer, timeout=10):
+    deadline = time.time() + timeout
+    while background_writer.error is None and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class FeatureWriterTest(parameterized.TestCase):
+
+    def open_writers(self, names):
+        folder = self.create_tempdir().full_path
+        writers = [feature_writer.FeatureWriter(os.path.join(folder, name + '.bin' + feature_writer.COMPRESSED_SUFFIX))
+                   for name in names]
+        for w in writers:
+            self.addCleanup(w.close)
+        return writers
+
+    def start(self, writers, use_uring):
+        if use_uring and feature_writer.liburing is None:
+            self.skipTest('liburing is not installed')
+        with mock.patch.object(feature_writer, 'liburing', feature_writer.liburing if use_uring else None):
+            background_writer = feature_writer.BackgroundWriter(writers)
+        if use_uring and background_writer.uring is None:
+            background_writer.close()
+            self.skipTest('io_uring is not usable on this kernel')
+        return background_writer
+
+    @parameterized.parameters(True, False)
+    def test_many_small_batches_round_trip(self, use_uring):
+        screen, minimap, player = writers = self.open_writers(['screen_creep', 'minimap_creep', 'player'])
+        background_writer = self.start(writers, use_uring)
+        screen_frames, minimap_frames = random_layers(200, 0), random_layers(200, 1)
+        player_frames = [np.arange(i, i + 11) for i in range(200)]
+        out_buf = np.empty(feature_encoder.max_record_size(SHAPE), dtype=np.uint8)
+        for game_loop in range(200):
+            size = feature_encoder.encode_feature(screen_frames[game_loop], game_loop, out_buf)
+            screen.write(out_buf[:size].tobytes())
+            # Every other frame has no minimap record, so batches hold a varying number of files
+            if game_loop % 2:
+                size = feature_encoder.encode_feature(minimap_frames[game_loop], game_loop, out_buf)
+                minimap.write(out_buf[:size].tobytes())
+            player.write(feature_encoder.encode_array(player_frames[game_loop], game_loop))
+            background_writer.flush(writers, threshold=200)
+        background_writer.flush(writers, threshold=0)
+        background_writer.close()
+
+        frames = list(replay_reader.read_feature_layer(screen.file.name, SHAPE))
+        self.assertEqual([game_loop for game_loop, _ in frames], list(range(200)))
+        for (game_loop, arr) in frames:
+            np.testing.assert_array_equal(arr, screen_frames[game_loop])
+        frames = list(replay_reader.read_feature_layer(minimap.file.name, SHAPE))
+        self.assertEqual([game_loop for game_loop, _ in frames], list(range(1, 200, 2)))
+        for (game_loop, arr) in frames:
+            np.testing.assert_array_equal(arr, minimap_frames[game_loop])
+        frames = list(replay_reader.read_array_feature(player.file.name))
+        self.assertEqual([game_loop for game_loop, _ in frames], list(range(200)))
+        for (game_loop, arr) in frames:
+            np.testing.assert_array_equal(arr, player_frames[game_loop])
+
+    @parameterized.parameters(True, False)
+    def test_write_error_is_raised_by_next_flush(self, use_uring):
+        writers = self.open_writers(['screen_creep', 'player'])
+        background_writer = self.start(writers, use_uring)
+        with mock.patch.object(feature_writer, 'compress', side_effect=OSError('No space left on device')):
+            for w in writers:
+                w.write(b'frame')
+            background_writer.flush(writers, threshold=0)
+            wait_for_error(background_writer)
+            for w in writers:
+                w.write(b'frame')
+            with self.assertRaises(OSError):
+                background_writer.flush(writers)
+        # The failed batches are dropped, later ones are not queued behind them
+        self.assertEqual([bytes(w.buf) for w in writers], [b'frame', b'frame'])
+        with self.assertRaises(OSError):
+            background_writer.close()
+
+    def test_interrupted_flush_keeps_buffers(self):
+        writers = self.open_writers(['screen_creep', 'player'])
+        background_writer = self.start(writers, use_uring=False)
+        for w in writers:
+            w.write(b'frame')
+        with mock.patch.object(background_writer.queue, 'put', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                background_writer.flush(writers, threshold=0)
+        self.assertEqual([bytes(w.buf) for w in writers], [b'frame', b'frame'])
+        background_writer.close()
+
+    def test_write_fully_finishes_short_writes(self):
+        w, = self.open_writers(['player'])
+        real_write = os.write
+        with mock.patch.object(os, 'write', side_effect=lambda fd, data: real_write(fd, data[:7])) as write:
+            feature_writer.write_fully(w.fd, b'0123456789' * 5)
+        self.assertEqual(write.call_count, 8)
+        with open(w.file.name, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789' * 5)
+
+
+if __name__ == '__main__':
+    absltest.main()
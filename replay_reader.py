@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import struct
+
+import numpy as np
+
+# Every screen/minimap record starts with (tag, n_data, n_indices, game_loop), all little-endian.
+# Sparse records are followed by data as int16, indices as int32 and indptr (rows + 1 entries) as int32.
+# Dense records are followed by the whole rows x cols layer as int16 (n_data == rows * cols, n_indices == 0).
+RECORD_HEADER = struct.Struct('<cIII')
+SPARSE_TAG = b'S'
+DENSE_TAG = b'D'
+DATA_DTYPE = np.dtype('<i2')
+INDEX_DTYPE = np.dtype('<i4')
+
+# Other features (player, score_cumulative, available_actions, ...) are written as one record per frame:
+# (game_loop, ndim), ndim uint32 dimensions, then the array as int32, all little-endian.
+ARRAY_HEADER = struct.Struct('<IB')
+ARRAY_DTYPE = np.dtype('<i4')
+
+
+def read_feature_layer(path, shape):
+    """Yield (game_loop, dense array) for every frame stored in a screen_*/minimap_* .bin(.zst/.gz) file."""
+    rows = shape[0]
+    with open_feature_file(path) as f:
+        while True:
+            header = read_exact(f, RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            tag, n_data, n_indices, game_loop = RECORD_HEADER.unpack(header)
+            data = np.frombuffer(read_exact(f, n_data * DATA_DTYPE.itemsize), dtype=DATA_DTYPE)
+            if tag == DENSE_TAG:
+                # frombuffer views are read-only, copy so dense frames are writable like the sparse ones
+                yield game_loop, data.reshape(shape).copy()
+                continue
+            indices = np.frombuffer(read_exact(f, n_indices * INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)
+            indptr = np.frombuffer(read_exact(f, (rows + 1) * INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)
+            yield game_loop, csr_to_dense(data, indices, indptr, shape)
+
+
+def read_array_feature(path):
+    """Yield (game_loop, array) for every frame stored in an other feature .bin(.zst/.gz) file, e.g. player."""
+    with open_feature_file(path) as f:
+        while True:
+            header = read_exact(f, ARRAY_HEADER.size)
+            if len(header) < ARRAY_HEADER.size:
+                return
+            game_loop, ndim = ARRAY_HEADER.unpack(header)
+            shape = struct.unpack('<%dI' % ndim, read_exact(f, 4 * ndim))
+            size = int(np.prod(shape))
+            data = np.frombuffer(read_exact(f, size * ARRAY_DTYPE.itemsize), dtype=ARRAY_DTYPE)
+            yield game_loop, data.reshape(shape).copy()
+
+
+def open_feature_file(path):
+    # data_extraction.py compresses with zstd when the zstandard package is installed, gzip otherwise
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_exact(f, size):
+    # Decompressing readers may return short reads before the end of the stream
+    chunks = []
+    while size > 0:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def csr_to_dense(data, indices, indptr, shape):
+    arr = np.zeros(shape, dtype=data.dtype)
+    row_ids = np.repeat(np.arange(shape[0]), np.diff(indptr))
+    arr[row_ids, indices] = data
+    return arr